@@ -1,139 +1,222 @@
 import argparse
 import json
+import logging
+import os
 from datetime import datetime
 from decimal import Decimal, ROUND_HALF_UP
+from functools import lru_cache
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv
+
+logger = logging.getLogger(__name__)
 
 QUANTIZE_ROUND = Decimal('0.00')
-INTERVAL_TIME_IN_SECONDS = 0
 DEFAULT_ENERGY_FLOW_CSV_PATH = "energy_flow.csv"
 DEFAULT_ENERGY_TARIFF_JSON_PATH = "energy_tariff.json"
+MINUTES_PER_DAY = 24 * 60
+DAY_TYPES = ("Weekday", "Weekend")
 
 
 def round_decimal(input: Decimal) -> Decimal:
     return input.quantize(QUANTIZE_ROUND, rounding=ROUND_HALF_UP)
 
 
-def round_float_to_decimal(input: float) -> Decimal:
-    return round_decimal(Decimal(input))
+def round_half_up(values: np.ndarray) -> np.ndarray:
+    # Same rounding as round_decimal, applied to a whole float array at once.
+    # The inner np.round absorbs float noise, e.g. 12.499999999999998 -> 12.5
+    cents = np.round(np.abs(values) * 100, 6)
+    return np.sign(values) * np.floor(cents + 0.5) / 100
 
 
 def create_energy_flow_df(path: str) -> pd.DataFrame:
-    energy_flow_df = pd.read_csv(path, parse_dates=['datetime'])
-    print("-" * 100)
-    print("Energy flow values")
-    print(energy_flow_df)
-    print("-" * 100)
+    # Arrow would convert timestamps with a UTC offset to UTC, but tariffs
+    # apply to local wall-clock time, so the datetimes are parsed by pandas
+    convert_options = csv.ConvertOptions(
+        column_types={
+            "datetime": pa.string(),
+            "grid_energy_flow_kW": pa.float64(),
+            "battery_energy_flow_kW": pa.float64(),
+        }
+    )
+    energy_flow_df = csv.read_csv(path, convert_options=convert_options).to_pandas()
+    energy_flow_df["datetime"] = pd.to_datetime(energy_flow_df["datetime"])
+    # Lazy %s formatting: the frame is only rendered when debug logging is on
+    logger.debug("Energy flow values:\n%s", energy_flow_df)
     return energy_flow_df
 
 
 def create_energy_tariffs_dict(path: str) -> dict:
-    with open(path, 'r') as file:
-        tariffs = json.load(file)
-
-    # Iterate through the dictionary to convert all float values to Decimal
-    for day, times in tariffs.items():
-        for time_range, rate in times.items():
-            tariffs[day][time_range] = round_float_to_decimal(rate)
+    # Keyed on the absolute path, so the same relative path from another
+    # working directory is a different entry, and on the modification time,
+    # so an edited file is parsed again
+    return load_energy_tariffs(os.path.abspath(path), os.stat(path).st_mtime_ns)
 
-    return tariffs
-
-
-def get_day_type(date_time: datetime) -> str:
-    return "Weekday" if date_time.weekday() < 5 else "Weekend"
 
+@lru_cache(maxsize=8)
+def load_energy_tariffs(path: str, modification_time_ns: int) -> dict:
+    with open(path, 'rb') as file:
+        tariffs = json.load(file)
 
-def get_current_tariff(date_time: datetime, tariffs: dict) -> Decimal:
-    day_type = get_day_type(date_time)
-    time_str = date_time.strftime("%H:%M")
-    for time_range, tariff in tariffs[day_type].items():
+    # Parse the "HH:MM-HH:MM" time ranges once, into one row of per-minute
+    # rates for each of DAY_TYPES. A day type missing from the file has no
+    # rate for any minute
+    minute_rates = np.full((len(DAY_TYPES), MINUTES_PER_DAY), np.nan)
+    for day_type_idx, day_type in enumerate(DAY_TYPES):
+        if day_type in tariffs:
+            minute_rates[day_type_idx] = parse_day_tariffs(tariffs[day_type])
+    # Every caller shares the cached table, so make sure nobody can modify it
+    minute_rates.flags.writeable = False
+    return {"minute_rates": minute_rates}
+
+
+def get_minute_of_day(time_str: str) -> int:
+    time = datetime.strptime(time_str, "%H:%M")
+    return time.hour * 60 + time.minute
+
+
+def parse_day_tariffs(day_tariffs: dict) -> np.ndarray:
+    # Rate of every minute of the day, NaN where no time range covers it
+    minute_rates = np.full(MINUTES_PER_DAY, np.nan)
+    # Fill in reverse file order, so where ranges overlap the first one listed
+    # wins, same as a first-match scan over the ranges
+    for time_range, rate in reversed(list(day_tariffs.items())):
         start, end = time_range.split("-")
-        if start <= time_str <= end:
-            return tariff
-
-    print(f"ERROR: couldn't find an energy tariff for the interval {datetime}. Defaulting the price to 0")
-    return Decimal(0)
-
-
-def calculate_battery_cost(
-    battery_replacement_cost: Decimal,
-    battery_capacity_in_kwh: float,
-    battery_rated_cycles: int,
-    energy_flow_kw: float,
-) -> Decimal:
-    battery_energy_flow_kwh = calculate_energy_flow_in_kwh(energy_flow_kw)
-    degradation = (abs(battery_energy_flow_kwh) / battery_capacity_in_kwh) / (
-        battery_rated_cycles / 2
-    )
-    battery_cost = Decimal(degradation) * battery_replacement_cost
-    return round_decimal(battery_cost)
-
-
-def calculate_energy_flow_in_kwh(energy_flow: float) -> float:
-    return energy_flow * (INTERVAL_TIME_IN_SECONDS / 3600)
-
+        minute_rates[get_minute_of_day(start) : get_minute_of_day(end) + 1] = rate
+    return minute_rates
+
+
+def get_minute_of_day_and_is_weekend(date_times: pd.Series) -> tuple:
+    # Weekdays are 0-4 and weekend days 5-6, read through the vectorized .dt fields
+    if not pd.api.types.is_datetime64_any_dtype(date_times):
+        # Mixed UTC offsets, e.g. across a DST change, leave an object column
+        # of Timestamps. Tariffs apply to local wall-clock time, so drop the
+        # offsets and keep each timestamp's own hour, minute and weekday
+        date_times = pd.to_datetime(
+            [date_time.replace(tzinfo=None) for date_time in date_times]
+        ).to_series(index=date_times.index)
+    date_time_fields = date_times.dt
+    minute_of_day = (date_time_fields.hour * 60 + date_time_fields.minute).to_numpy()
+    is_weekend = date_time_fields.weekday.to_numpy() >= 5
+    return minute_of_day, is_weekend
+
+
+def get_tariffs_for_datetimes(date_times: pd.Series, tariffs: dict) -> np.ndarray:
+    minute_of_day, is_weekend = get_minute_of_day_and_is_weekend(date_times)
+    # Rows follow DAY_TYPES (0: Weekday, 1: Weekend), so each interval's
+    # tariff is a single fancy-index into the table
+    current_tariffs = tariffs["minute_rates"][is_weekend.astype(np.intp), minute_of_day]
+
+    missing = np.isnan(current_tariffs)
+    if missing.any():
+        logger.warning(
+            "Couldn't find an energy tariff for %d intervals (first one: %s). "
+            "Defaulting the price to 0",
+            missing.sum(),
+            date_times[missing].iloc[0],
+        )
+    return np.where(missing, 0.0, current_tariffs)
 
-def calculate_grid_cost(
-    grid_energy_flow_kw: float, date_time: datetime, energy_tariffs: dict
-) -> Decimal:
-    grid_energy_flow_kwh = calculate_energy_flow_in_kwh(grid_energy_flow_kw)
-    if Decimal(grid_energy_flow_kwh).is_zero():
-        return Decimal(0)
 
-    current_tariff = get_current_tariff(date_time, energy_tariffs)
-    grid_cost = current_tariff * Decimal(grid_energy_flow_kwh)
-    return round_decimal(grid_cost)
+def calculate_energy_flow_in_kwh(
+    energy_flow: float, interval_time_in_seconds: float
+) -> float:
+    return energy_flow * (interval_time_in_seconds / 3600)
 
 
 def main(args):
     energy_flow_df = create_energy_flow_df(path=args.energy_flow_path)
     energy_tariffs = create_energy_tariffs_dict(path=args.energy_tariff_costs_path)
-    find_interval_time_from_dataframe(energy_flow_df)
+    interval_time_in_seconds = find_interval_time_from_dataframe(energy_flow_df)
+    # Namespaces built by callers predating --verbose don't have the field
+    verbose = getattr(args, "verbose", False)
 
     cost_by_interval_df = calculate_costs_for_each_interval(
-        args, energy_flow_df, energy_tariffs
+        args, energy_flow_df, energy_tariffs, interval_time_in_seconds
     )
-    print("-" * 100)
+    if verbose:
+        print("-" * 100)
     print("Costs per interval in AUD:")
-    print(cost_by_interval_df)
-
-    total_time_window_cost = round_float_to_decimal(
-        cost_by_interval_df["total_cost"].sum()
-    )
+    with pd.option_context("display.float_format", "{:,.2f}".format):
+        print(cost_by_interval_df)
+
+    # Interval costs are whole cents, so sum them as integers to keep float
+    # accumulation error out of the total. Like Series.sum, skip intervals
+    # whose cost is NaN because of a missing flow value
+    total_cents = np.nansum(np.rint(cost_by_interval_df["total_cost"].to_numpy() * 100))
+    total_time_window_cost = round_decimal(Decimal(int(total_cents)) / 100)
     print("")
     print(f"Total cost for the whole time window: {total_time_window_cost} AUD")
-    print("-" * 100)
+    if verbose:
+        print("-" * 100)
 
 
 def calculate_costs_for_each_interval(
-    args, energy_flow_df: pd.DataFrame, energy_tariffs: dict
+    args,
+    energy_flow_df: pd.DataFrame,
+    energy_tariffs: dict,
+    interval_time_in_seconds: float,
 ) -> pd.DataFrame:
-    cost_by_interval_df = pd.DataFrame(
-        index=energy_flow_df.index, columns=["grid_cost", "battery_cost", "total_cost"]
+    grid_energy_flow_kw, battery_energy_flow_kw = (
+        energy_flow_df[["grid_energy_flow_kW", "battery_energy_flow_kW"]]
+        .to_numpy(dtype=np.float64)
+        .T
     )
-    for idx, row in energy_flow_df.iterrows():
-        grid_cost = calculate_grid_cost(
-            grid_energy_flow_kw=row["grid_energy_flow_kW"],
-            date_time=row["datetime"],
-            energy_tariffs=energy_tariffs,
-        )
-        battery_cost = calculate_battery_cost(
-            battery_replacement_cost=args.battery_replacement_cost,
-            battery_capacity_in_kwh=args.battery_capacity_in_kwh,
-            battery_rated_cycles=args.battery_rated_cycles,
-            energy_flow_kw=row["battery_energy_flow_kW"],
-        )
-        total_cost = grid_cost + battery_cost
-        cost_by_interval_df.loc[idx] = [grid_cost, battery_cost, total_cost]
-    return cost_by_interval_df
+    # Degradation cost of moving one kWh through the battery
+    battery_cost_per_kwh = (
+        args.battery_replacement_cost
+        / args.battery_capacity_in_kwh
+        / (args.battery_rated_cycles / 2)
+    )
+
+    grid_cost, battery_cost, total_cost = calculate_costs_batch(
+        grid_energy_flow_kw=grid_energy_flow_kw,
+        battery_energy_flow_kw=battery_energy_flow_kw,
+        date_times=energy_flow_df["datetime"],
+        energy_tariffs=energy_tariffs,
+        interval_time_in_seconds=interval_time_in_seconds,
+        battery_cost_per_kwh=battery_cost_per_kwh,
+    )
+    return pd.DataFrame(
+        {
+            "grid_cost": grid_cost,
+            "battery_cost": battery_cost,
+            "total_cost": total_cost,
+        },
+        index=energy_flow_df.index,
+    )
+
+
+def calculate_costs_batch(
+    grid_energy_flow_kw: np.ndarray,
+    battery_energy_flow_kw: np.ndarray,
+    date_times: pd.Series,
+    energy_tariffs: dict,
+    interval_time_in_seconds: float,
+    battery_cost_per_kwh: float,
+) -> tuple:
+    kwh_per_kw = calculate_energy_flow_in_kwh(1.0, interval_time_in_seconds)
+    grid_energy_flow_kwh = grid_energy_flow_kw * kwh_per_kw
+    battery_energy_flow_kwh = battery_energy_flow_kw * kwh_per_kw
 
+    # Intervals without grid flow keep a 0 cost, so only those with flow
+    # need a tariff lookup
+    has_grid_flow = grid_energy_flow_kwh != 0
+    grid_cost = np.zeros_like(grid_energy_flow_kwh)
+    if has_grid_flow.any():
+        tariffs = get_tariffs_for_datetimes(date_times[has_grid_flow], energy_tariffs)
+        grid_cost[has_grid_flow] = tariffs * grid_energy_flow_kwh[has_grid_flow]
+    battery_cost = np.abs(battery_energy_flow_kwh) * battery_cost_per_kwh
 
-def find_interval_time_from_dataframe(energy_flow_df):
-    datetime_first = energy_flow_df.loc[0, "datetime"]
-    datetime_second = energy_flow_df.loc[1, "datetime"]
-    global INTERVAL_TIME_IN_SECONDS
-    INTERVAL_TIME_IN_SECONDS = (datetime_second - datetime_first).total_seconds()
+    grid_cost = round_half_up(grid_cost)
+    battery_cost = round_half_up(battery_cost)
+    return grid_cost, battery_cost, grid_cost + battery_cost
+
+
+def find_interval_time_from_dataframe(energy_flow_df: pd.DataFrame) -> float:
+    return energy_flow_df["datetime"].diff().iloc[1].total_seconds()
 
 
 if __name__ == "__main__":
@@ -154,7 +237,7 @@ if __name__ == "__main__":
         "-b",
         "--battery_replacement_cost",
         default=1000,
-        type=Decimal,
+        type=float,
         help="Cost of replacing the battery once it has reached the end of its life in AUD",
     )
     parser.add_argument(
@@ -171,6 +254,17 @@ if __name__ == "__main__":
         type=int,
         help="Number of charge/discharge cycles the battery is rated for.",
     )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Print the input energy flow values and section separators",
+    )
     args = parser.parse_args()
 
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.WARNING,
+        format="%(levelname)s: %(message)s",
+    )
+
     main(args)